@@ -4,15 +4,18 @@ import numpy as np
 import math
 import os
 import sys
-import pkg_resources
+import importlib.metadata
 import subprocess
+from dataclasses import dataclass
+from functools import lru_cache
+from rdkit import Chem
 
 #Function to check for the presence of a package and install it if not present.
 def install_package(package):
     try:
-        pkg_resources.require(package)
+        importlib.metadata.version(package)
         #print(f"{package} is already installed.")
-    except pkg_resources.DistributionNotFound:
+    except importlib.metadata.PackageNotFoundError:
         print(f"{package} not found. Installing...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
@@ -25,28 +28,56 @@ from gnps_postprocessing.gnps_download_results import *
 from gnps_postprocessing.consolidate_structures import *
 from gnps_postprocessing.gnps_results_postprocess import *
 
+#Cache the RDKit-based salt removal, as the same SMILES recur across compound libraries
+remove_salt_from_SMILES = lru_cache(maxsize=None)(remove_salt_from_SMILES)
+
+#Results of prepare_for_virtual_metabolization: the deduplicated annotation table and the compound names/SMILES to metabolize.
+@dataclass
+class PreparedAnnotations:
+    df: pd.DataFrame
+    compound_names: list
+    smiles: list
+
+#Compounds loaded by load_extra_compounds from a user-provided table.
+@dataclass
+class ExtraCompounds:
+    compound_names: list
+    smiles: list
+
 #Function to print out compound names in a sorted order and then clear the list. Primarily used for displaying missing compounds.  
 def print_compound_names(list_compounds):
     for item in sorted(list_compounds):
         print(' > '+'\''+item+'\',')
     del list_compounds
 
+#Function to convert the string columns that are repeatedly filtered and deduplicated to categorical dtype, so pandas hashes integer codes instead of Python strings. Missing columns are skipped.
+def convert_to_categorical(df_annotations, columns):
+    columns = [c for c in columns if c != False and c in df_annotations.columns and df_annotations[c].dtype != 'category']
+    if columns:
+        df_annotations = df_annotations.astype({c: 'category' for c in columns})
+    return df_annotations
+
 #Function to process GNPS annotations, filter based on structure identifiers, and display statistics and warnings about the processed annotations.
 def get_info_gnps_annotations(df_annotations, inchi_column, smiles_column, smiles_planar_column=False):
     #Get info on consolidated GNPS annotation table
+    df_annotations = convert_to_categorical(df_annotations, ['Compound_Name', smiles_planar_column, 'tags'])
+    #Arrow-backed strings let the startswith scan below run on Arrow's string kernels
+    df_annotations = df_annotations.astype({inchi_column: 'string[pyarrow]'})
     
-    df_annotations_missing_structure = df_annotations[~df_annotations[inchi_column].str.startswith('InChI', na=False)]
+    #Compute the structure identifier mask once and reuse it for both subsets
+    mask_structure = df_annotations[inchi_column].str.startswith('InChI', na=False).to_numpy(dtype=bool, na_value=False)
+    df_annotations_missing_structure = df_annotations[~mask_structure]
 
     number_of_annotations = df_annotations.shape[0]
     number_of_annotations_without_structure = df_annotations_missing_structure.shape[0]
 
     print(str(number_of_annotations)+' annotations detected')
-    list_unique_stereostructure = set(df_annotations[smiles_column])
-    print('that corresponds to '+str(len(list_unique_stereostructure))+' unique stereostructures')
+    number_of_unique_stereostructures = df_annotations[smiles_column].nunique(dropna=True)
+    print('that corresponds to '+str(number_of_unique_stereostructures)+' unique stereostructures')
     
     if smiles_planar_column != False:
-        list_unique_planarstructure = set(df_annotations[smiles_planar_column])
-        print('that corresponds to '+(str(len(list_unique_planarstructure)))+' unique planar structures')
+        number_of_unique_planarstructures = df_annotations[smiles_planar_column].nunique(dropna=True)
+        print('that corresponds to '+str(number_of_unique_planarstructures)+' unique planar structures')
 
     print(' ==== WARNING =====')
     print('######'+str(number_of_annotations_without_structure)+' annotations dont have a structure identifier and will be discarded from downstream processing, unless you do the following:')
@@ -55,37 +86,61 @@ def get_info_gnps_annotations(df_annotations, inchi_column, smiles_column, smile
     list_missing_compounds = set(df_annotations_missing_structure['Compound_Name'])
     print_compound_names(list_missing_compounds)
     
-    df_annotations = df_annotations[df_annotations[inchi_column].str.startswith('InChI', na=False)]
+    df_annotations = df_annotations[mask_structure]
 
     return df_annotations
 
 #Function to filter and print compound names based on the length of their associated tags. Used for detailed insights into specific compounds.
 def print_compound_name_for_tags(df_annotations):
-        mask = (df_annotations['tags'].astype('str').str.len() > 4)
+        tags = df_annotations['tags']
+        if tags.dtype == 'category':
+            #Evaluate the tag length once per category instead of once per row
+            categories = tags.cat.categories
+            mask = tags.isin(categories[categories.astype(str).str.len() > 4])
+        else:
+            mask = tags.notna() & (tags.astype(str).str.len() > 4)
         df = df_annotations.loc[mask]
         df = df.drop_duplicates(subset=['Compound_Name'])
         return df.sort_values(['tags'])[['tags','Compound_Name']]
     
 #Function to filter a DataFrame of annotations based on provided compound names or tags, allowing a more targeted analysis.
-def df_annotations_filtering(df_annotations, compound_name=False, tags=False):
-    #If compound names or tags are available, we generate subtables
-    if compound_name != False:
-        df_annotations_name = df_annotations[df_annotations.Compound_Name.isin(compound_name)]
-    if tags != False:
-        df_annotations_tags = df_annotations[df_annotations.tags.isin(tags)]
-     
-    if compound_name != False and tags != False :
-        df_annotations = pd.concat([df_annotations_name, df_annotations_tags], ignore_index=True)
-        
-    elif compound_name != False:
-        df_annotations = df_annotations_name
-        
-    elif tags != False:
-        df_annotations = df_annotations_tags
-    else:
+def df_annotations_filtering(df_annotations, compound_name=None, tags=None):
+    #If compound names or tags are available, we combine them into a single mask (rows matching both are kept once)
+    if not compound_name and not tags:
         print('No Compound_Name or Tags filter used')
+        return df_annotations
+
+    mask = pd.Series(False, index=df_annotations.index)
+    if compound_name:
+        mask |= df_annotations.Compound_Name.isin(set(compound_name))
+    if tags:
+        mask |= df_annotations.tags.isin(set(tags))
         
-    return df_annotations
+    return df_annotations.loc[mask]
+
+#Function to return the RDKit canonical SMILES of a structure, so that different writings of the same molecule collapse to one string. Cached as the same SMILES recur across annotations; unparsable SMILES are returned unchanged.
+@lru_cache(maxsize=None)
+def canonical_smiles(smiles, isomeric=True):
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return smiles
+    return Chem.MolToSmiles(mol, canonical=True, isomericSmiles=isomeric)
+
+#Function to keep the best scoring (MQScore) annotation per canonical structure. Falls back to keeping the first occurrence when no MQScore is available (e.g. SIRIUS tables).
+def drop_duplicated_structures(df_annotations, smiles_col, isomeric=True):
+    df_annotations = df_annotations.assign(_canonical=df_annotations[smiles_col].map(lambda x: canonical_smiles(x, isomeric=isomeric)))
+    try:
+        #Missing scores rank last; a finite sentinel is used as groupby idxmax mishandles NaN/-inf only groups
+        scores = pd.to_numeric(df_annotations['MQScore'], errors='coerce').fillna(np.finfo(np.float64).min)
+        #Work on row positions (RangeIndex) so that repeated index labels in the input do not matter
+        scores = scores.reset_index(drop=True)
+        positions = scores.groupby(df_annotations['_canonical'].reset_index(drop=True), sort=False, observed=True).idxmax().to_numpy()
+        #Only the deduplicated rows are sorted, to keep the best annotations first
+        positions = positions[np.argsort(-scores.to_numpy()[positions], kind='stable')]
+        df_annotations = df_annotations.iloc[positions]
+    except KeyError:
+        df_annotations = df_annotations.drop_duplicates(subset='_canonical', keep='first')
+    return df_annotations.drop(columns='_canonical')
 
 #Function to prepare data for virtual metabolization by performing duplicate filtering, and selecting between planar or stereo structures based on the parameters.
 def prepare_for_virtual_metabolization(df_annotations, compound_name, smiles_planar_column,  smiles_column=False, drop_duplicated_structure = True, use_planar_structure = True):
@@ -94,101 +149,136 @@ def prepare_for_virtual_metabolization(df_annotations, compound_name, smiles_pla
     #Do some duplicate filtering and select planar or stereo structure
     
     #print('Number of spectral library annotations = '+str(df_annotations.shape[0]))
+    df_annotations = convert_to_categorical(df_annotations, [compound_name, smiles_planar_column, 'tags'])
     
     if use_planar_structure == True:
-        df_annotations = df_annotations[df_annotations[smiles_planar_column].str.contains('nan') == False]
+        col_vals = df_annotations[smiles_planar_column]
+        df_annotations = df_annotations[col_vals.notna() & (col_vals.values != 'nan')]
         #print('Number of spectral annotations with planar SMILES/InChI = '+str(df_annotations.shape[0]))
 
         if drop_duplicated_structure == True:
-            try: 
-                df_annotations = df_annotations.sort_values(by=['MQScore'], ascending=False)
-            except:
-                pass
-            df_annotations = df_annotations.drop_duplicates(subset=smiles_planar_column, keep='first')
-
-        list_compound_name = list(df_annotations[compound_name])
-        list_smiles = list(df_annotations[smiles_planar_column])
+            #Deduplicate on canonical SMILES so that different writings of the same structure are collapsed
+            df_annotations = drop_duplicated_structures(df_annotations, smiles_planar_column, isomeric=False)
+
+        list_compound_name = df_annotations[compound_name].to_numpy().tolist()
+        list_smiles = df_annotations[smiles_planar_column].to_numpy().tolist()
         #print('Number of unique planar SMILES considered = '+str(len(list_smiles)))
     
     else:
-        df_annotations = df_annotations[df_annotations[smiles_column].str.contains('nan') == False]
+        col_vals = df_annotations[smiles_column]
+        df_annotations = df_annotations[col_vals.notna() & (col_vals.values != 'nan')]
         #print('Number of spectral annotations with valid SMILES or InChI = '+str(df_annotations.shape[0]))
         
         if drop_duplicated_structure == True:
-            try: 
-                df_annotations = df_annotations.sort_values(by=['MQScore'], ascending=False)
-            except:
-                pass
-            
-            df_annotations = df_annotations.drop_duplicates(subset=smiles_column, keep='first')
-
-        list_compound_name = list(df_annotations[compound_name])
-        list_smiles = list(df_annotations[smiles_column])
+            #Deduplicate on canonical SMILES so that different writings of the same structure are collapsed
+            df_annotations = drop_duplicated_structures(df_annotations, smiles_column)
+
+        list_compound_name = df_annotations[compound_name].to_numpy().tolist()
+        list_smiles = df_annotations[smiles_column].to_numpy().tolist()
         #print('Number of unique SMILES = '+str(len(list_smiles)))
         
-    prepare_for_virtual_metabolization.list_compound_name = list_compound_name
-    prepare_for_virtual_metabolization.list_smiles = list_smiles
-    
-    return df_annotations
+    return PreparedAnnotations(df_annotations, list_compound_name, list_smiles)
 
 #Function to load additional compounds from a specified file, expecting a two-column format with compound names and SMILES without headers.
 def load_extra_compounds(path):
-    #Table must be two columns tab-separeted with compound and smiles (no headers).
-    extra_compounds_table = pd.read_csv(path, sep='\t')
-    load_extra_compounds.extra_compound_names = extra_compounds_table.iloc[:,0].to_list()
-    load_extra_compounds.extra_compound_smiles = extra_compounds_table.iloc[:,1].to_list()
+    #Table must be two columns tab-separeted with compound and smiles (no headers), or a Parquet/Feather file with these two columns.
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        extra_compounds_table = pd.read_parquet(path)
+    elif extension == '.feather':
+        extra_compounds_table = pd.read_feather(path)
+    else:
+        extra_compounds_table = pd.read_csv(path, sep='\t')
+    extra_compounds = ExtraCompounds(extra_compounds_table.iloc[:,0].to_list(), extra_compounds_table.iloc[:,1].to_list())
 
-    if len(load_extra_compounds.extra_compound_names) != len(load_extra_compounds.extra_compound_smiles):
+    if len(extra_compounds.compound_names) != len(extra_compounds.smiles):
         print('!!!!!! VERIFY THE INTEGRITY OF THE FILE FOR EXTRA COMPOUNDS !!!!!!!!! -> DIFFERENT NUMBER OF COMPOUNDS NAME AND SMILES')
+
+    return extra_compounds
         
 #Function to append new compounds to the base lists if they are not already present, ensuring uniqueness and cleaning the SMILES strings from salts and certain characters.
 def append_to_list_if_not_present(base_list_names, base_list_smiles, extra_list_names, extra_list_smiles):
     #print('Initial number of compound names in the list = ' + str(len(base_list_names)))
     #print('Initial number of SMILES in the list = ' + str(len(base_list_smiles)))
 
-    for n, s in zip(extra_list_names, extra_list_smiles):
-        #Remove salts from SMILES and process the molecule
-        cleaned_smiles = remove_salt_from_SMILES(s) if '.' in s else s
-        cleaned_smiles = cleaned_smiles.replace('@', '')
+    #Keep a set of the canonical SMILES already present for constant-time membership tests
+    seen = set(canonical_smiles(s) for s in base_list_smiles)
+
+    #Clean each distinct input SMILES only once, then broadcast the results back to the rows
+    codes, unique_smiles = pd.factorize(pd.Series(extra_list_smiles, dtype=object), use_na_sentinel=False)
+    unique_smiles = pd.Series(unique_smiles, dtype=object)
+
+    #Remove salts from SMILES (only for multi-fragment entries) and strip stereo markers in bulk
+    has_salt = unique_smiles.str.contains('.', regex=False, na=False)
+    unique_smiles = unique_smiles.where(~has_salt, unique_smiles[has_salt].map(remove_salt_from_SMILES))
+    unique_smiles = unique_smiles.str.replace('@', '', regex=False)
+    unique_canonical = unique_smiles.map(canonical_smiles)
+
+    df_extra = pd.DataFrame({'name': extra_list_names,
+                             'smiles': unique_smiles.to_numpy()[codes],
+                             'canonical': unique_canonical.to_numpy()[codes]})
+    df_extra = df_extra[~df_extra['canonical'].isin(seen)]
+    df_extra = df_extra.drop_duplicates(subset='canonical', keep='first', ignore_index=True)
 
-        if cleaned_smiles not in base_list_smiles:
-            base_list_smiles.append(cleaned_smiles)
-            base_list_names.append(n)
+    base_list_smiles.extend(df_extra['smiles'].tolist())
+    base_list_names.extend(df_extra['name'].tolist())
 
     print('Final number of compound names in the list = ' + str(len(base_list_names)))
     print('Final number of SMILES in the list = ' + str(len(base_list_smiles)))
 
 #Function to load CSI:FingerID and COSMIC annotations from a specified file, selectively picking important columns for further processing.
 def load_csifingerid_cosmic_annotations(path_compound_identifications): 
+    #Multithreaded pyarrow parser, keeping Arrow-backed columns so string filters run on Arrow kernels
     df = pd.read_csv(path_compound_identifications,
                                 sep='\t', 
                                 usecols =['id','ConfidenceScore','ZodiacScore','name','links','smiles'], 
-                                low_memory=False)
-    df['name'] = df['name'].replace(np.nan, 'no_name', regex=True)
+                                engine='pyarrow',
+                                dtype_backend='pyarrow')
+    df['name'] = df['name'].fillna('no_name')
     return df 
 
-#Function to filter CSI:FingerID and COSMIC annotations based on provided criteria like Zodiac score, confidence score, and database links, enhancing data quality for subsequent analysis.
-def df_csifingerid_cosmic_annotations_filtering(compound_identification_table, zodiac_score=False, confidence_score=False, links=False):
-    
-    if zodiac_score != False:
+#Function to build the boolean mask of CSI:FingerID and COSMIC annotations passing the Zodiac and confidence score thresholds (all True when no threshold is given).
+def csifingerid_cosmic_scores_mask(compound_identification_table, zodiac_score=None, confidence_score=None):
+    mask = np.ones(len(compound_identification_table), dtype=bool)
+
+    score_conditions = []
+    if zodiac_score:
         #print('Filtering with ZodiacScore >= '+str(zodiac_score))
-        compound_identification_table = compound_identification_table[compound_identification_table['ZodiacScore']>=zodiac_score]
-        #print('Total entries remaining = '+str(compound_identification_table.shape[0]))
+        score_conditions.append('ZodiacScore >= @zodiac_score')
         print(' > Filtered with ZodiacScore')
         
-    if confidence_score != 0:
+    if confidence_score:
         #print('Filtering with Confidence Score >= '+str(confidence_score))
-        compound_identification_table = compound_identification_table[compound_identification_table['ConfidenceScore']>=confidence_score]
-        #print('Total entries remaining = '+str(compound_identification_table.shape[0]))
+        score_conditions.append('ConfidenceScore >= @confidence_score')
         print(' > Filtered with Confidence Score')
+
+    if score_conditions:
+        #Evaluate the numeric thresholds as a single expression
+        mask &= compound_identification_table.eval(' and '.join(score_conditions)).to_numpy(dtype=bool, na_value=False)
+
+    return mask
+
+#Function to build the boolean mask of CSI:FingerID and COSMIC annotations whose database links match the links pattern (all True when no pattern is given).
+def csifingerid_cosmic_links_mask(compound_identification_table, links=None):
+    if not links:
+        return np.ones(len(compound_identification_table), dtype=bool)
+
+    #print('Filtering with database links >= '+str(links))
+    mask = compound_identification_table['links'].str.contains(links, na=False).to_numpy(dtype=bool, na_value=False)
+    print(' > Filtered with Database Links')
+    return mask
+
+#Function to filter CSI:FingerID and COSMIC annotations based on provided criteria like Zodiac score, confidence score, and database links, enhancing data quality for subsequent analysis.
+def df_csifingerid_cosmic_annotations_filtering(compound_identification_table, zodiac_score=None, confidence_score=None, links=None):
+    
+    #Combine the active filters into a single mask and slice the table once
+    mask = (csifingerid_cosmic_scores_mask(compound_identification_table, zodiac_score, confidence_score)
+            & csifingerid_cosmic_links_mask(compound_identification_table, links))
         
-    if links != False:
-        #print('Filtering with database links >= '+str(links))
-        compound_identification_table = compound_identification_table[compound_identification_table['links'].str.contains(links, na=False)]
-        #print('Total entries remaining = '+str(compound_identification_table.shape[0]))
-        print(' > Filtered with Database Links')
-        
-    if zodiac_score == False and confidence_score == False and links == False:
+    if not zodiac_score and not confidence_score and not links:
         print(' > No filter was applied !')
         
+    compound_identification_table = compound_identification_table[mask]
+    #print('Total entries remaining = '+str(compound_identification_table.shape[0]))
+
     return compound_identification_table
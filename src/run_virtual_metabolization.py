@@ -11,7 +11,7 @@ from rdkit import RDLogger
 import shutil
 import traceback
 import requests
-import pkg_resources
+import importlib.metadata
 import zipfile
 import os
 import sys
@@ -22,9 +22,9 @@ lg.setLevel(RDLogger.ERROR)
 #Function to check for the presence of a package and install it if not present.
 def install_package(package):
     try:
-        pkg_resources.require(package)
+        importlib.metadata.version(package)
         #print(f"{package} is already installed.")
-    except pkg_resources.DistributionNotFound:
+    except importlib.metadata.PackageNotFoundError:
         print(f"{package} not found. Installing...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
@@ -1,14 +1,16 @@
 #Library imports
 import argparse
+import importlib.metadata
 import io
 import logging
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
 import pandas as pd
 from IPython.display import display, Markdown
-import re
-import subprocess
 
 #Get the absolute path of the root directory (one level up from 'src')
 root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -29,11 +31,19 @@ class StreamToLogger:
         self.linebuf = ''
 
     def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
+        #Only log complete lines; a partial line is kept in linebuf until its newline arrives
+        lines = (self.linebuf + buf).split('\n')
+        self.linebuf = lines.pop()
+        for line in lines:
+            line = line.rstrip()
+            if line:
+                self.logger.log(self.log_level, line)
 
     def flush(self):
-        pass
+        line = self.linebuf.rstrip()
+        self.linebuf = ''
+        if line:
+            self.logger.log(self.log_level, line)
 
 class SuppressOutput:
     """
@@ -47,53 +57,151 @@ class SuppressOutput:
     def __exit__(self, exc_type, exc_val, exc_tb):
         sys.stdout = self._original_stdout
 
+class FilteredLineWriter(io.TextIOBase):
+    """
+    Text stream that keeps complete lines in a list, dropping the ones starting with
+    one of the given prefixes as they are written (no second pass over the output).
+    """
+    def __init__(self, excluded_prefixes):
+        self.excluded_prefixes = excluded_prefixes
+        self.lines = []
+        self.linebuf = ''
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        lines = (self.linebuf + buf).split('\n')
+        self.linebuf = lines.pop()
+        self.lines.extend(line for line in lines if not line.startswith(self.excluded_prefixes))
+        return len(buf)
+
+    def getvalue(self):
+        lines = self.lines
+        if self.linebuf and not self.linebuf.startswith(self.excluded_prefixes):
+            lines = lines + [self.linebuf]
+        return '\n'.join(lines)
+
+class ListWriter(io.TextIOBase):
+    """
+    Text stream that appends the written chunks to a list and only joins them in getvalue().
+    """
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        self.parts.append(buf)
+        return len(buf)
+
+    def getvalue(self):
+        return ''.join(self.parts).rstrip('\n')
+
+class ThreadRoutedStdout(io.TextIOBase):
+    """
+    Stand-in for sys.stdout that sends the writes of each thread to the stream registered
+    for it by CaptureOutput, and everything else to the original stdout. This lets
+    concurrent steps capture their own output without clobbering each other.
+    """
+    def __init__(self, default):
+        self.default = default
+        self.streams = {}
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        return self.streams.get(threading.get_ident(), self.default).write(buf)
+
+    def flush(self):
+        self.streams.get(threading.get_ident(), self.default).flush()
+
 class CaptureOutput:
     """
-    Context manager to capture and filter the standard output.
+    Context manager to capture and filter the standard output of the current thread.
+    Pass an empty excluded_prefixes to capture everything without any per-line work.
     """
+    #Progress lines from SyGMa/BioTransformer that are left out of the captured output
+    EXCLUDED_PREFIXES = ("Applying", "Cycle")
+    _lock = threading.Lock()
+
+    def __init__(self, excluded_prefixes=EXCLUDED_PREFIXES):
+        self.excluded_prefixes = excluded_prefixes
+
     def __enter__(self):
-        self._original_stdout = sys.stdout
-        self._captured_stdout = io.StringIO()
-        sys.stdout = self._captured_stdout
+        if self.excluded_prefixes:
+            self._captured_stdout = FilteredLineWriter(self.excluded_prefixes)
+        else:
+            self._captured_stdout = ListWriter()
+
+        with CaptureOutput._lock:
+            if not isinstance(sys.stdout, ThreadRoutedStdout):
+                sys.stdout = ThreadRoutedStdout(sys.stdout)
+            self._router = sys.stdout
+            self._thread_id = threading.get_ident()
+            #Keep the stream this thread was writing to, to support nested captures
+            self._previous_stdout = self._router.streams.get(self._thread_id)
+            self._router.streams[self._thread_id] = self._captured_stdout
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self._original_stdout
+        with CaptureOutput._lock:
+            if self._previous_stdout is None:
+                del self._router.streams[self._thread_id]
+            else:
+                self._router.streams[self._thread_id] = self._previous_stdout
+            #Restore the original stdout once no thread is capturing anymore
+            if not self._router.streams and sys.stdout is self._router:
+                sys.stdout = self._router.default
 
     def get_filtered_output(self):
-        output = self._captured_stdout.getvalue()
-        filtered_output = '\n'.join(line for line in output.splitlines()
-                                    if not line.startswith("Applying") and not line.startswith("Cycle"))
-        return filtered_output
-
-#Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
-                    filename='vm_nap_log.txt', filemode='w')
-logging.getLogger('sygma').setLevel(logging.WARNING)  #Adjust the logger name if different
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-logging.getLogger('').addHandler(console)
-
-#Redirect stdout to logger
-sys.stdout = StreamToLogger(logging.getLogger('STDOUT'), logging.INFO)
+        return self._captured_stdout.getvalue()
+
+#Configure logging for command-line runs (not at import, so library use keeps the plain stdout)
+def configure_logging():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        filename='vm_nap_log.txt', filemode='w', force=True)
+    logging.getLogger('sygma').setLevel(logging.WARNING)  #Adjust the logger name if different
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    logging.getLogger('').addHandler(console)
+
+    #Redirect stdout to logger
+    sys.stdout = StreamToLogger(logging.getLogger('STDOUT'), logging.INFO)
 
 def package_version(package_name):
     """
-    Get the version of a Python package using pip, subprocess, and regular expressions.
+    Get the version of an installed Python package from its distribution metadata.
     """
     
-    result = subprocess.run(['pip', 'show', package_name], stdout=subprocess.PIPE, text=True)
+    try:
+        return importlib.metadata.version(package_name)
+    except importlib.metadata.PackageNotFoundError:
+        print(f"Version not found for the package {package_name}")
 
-    # Decode the result to a string (if using Python < 3.7, use result.stdout.decode())
-    output = result.stdout
+def load_gnps_annotations(job_id, force_refresh=False):
+    """
+    Get the GNPS annotation table of a job, reusing the Parquet copy cached in the job folder
+    by a previous run unless force_refresh is set. Fresh downloads are cached for the next run.
+    """
+    cached_annotations = os.path.join(job_id, 'df_annotations.parquet')
+    if not force_refresh and os.path.exists(cached_annotations):
+        print('Using cached GNPS annotations: '+cached_annotations)
+        return pd.read_parquet(cached_annotations)
 
-    # Use a regular expression to find the version number in the output
-    version_match = re.search(r'Version: (.+)', output)
-    if version_match:
-        version = version_match.group(1)
-        return version
-    else:
-        print(f"Version not found for the package {package_name}")
+    gnps_download_results(job_id, output_folder=job_id)
+    df_annotations = gnps_download_results.df_annotations
+    try:
+        os.makedirs(job_id, exist_ok=True)
+        df_annotations.to_parquet(cached_annotations, index=False)
+    except Exception as e:
+        print(f"Could not cache the GNPS annotations: {e}")
+        #Do not leave a partial file that the next run would try to load
+        if os.path.exists(cached_annotations):
+            os.remove(cached_annotations)
+    return df_annotations
 
 def main(args):
     """
@@ -108,36 +216,36 @@ def main(args):
     print( '')
 
     #Constructing the dynamic string based on provided arguments
-    dynamic_string = args.job_id if args.job_id.lower() != 'false' else 'no_job_id'
+    job_id = args.job_id
+    use_gnps_job = job_id.lower() != 'false'
+    dynamic_string_parts = [job_id if use_gnps_job else 'no_job_id']
 
     if args.sirius_input_file:
-        dynamic_string += "_" + os.path.splitext(os.path.basename(args.sirius_input_file))[0]
+        dynamic_string_parts.append(os.path.splitext(os.path.basename(args.sirius_input_file))[0])
 
     if args.extra_compounds_table_file:
-        dynamic_string += "_" + os.path.splitext(os.path.basename(args.extra_compounds_table_file))[0]
+        dynamic_string_parts.append(os.path.splitext(os.path.basename(args.extra_compounds_table_file))[0])
 
     if args.compound_name_to_keep:
-        dynamic_string += "_filtered_by_names"
+        dynamic_string_parts.append("filtered_by_names")
 
     #Adding a timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    dynamic_string += "_" + timestamp
+    dynamic_string_parts.append(datetime.now().strftime("%Y%m%d_%H%M%S"))
+    dynamic_string = "_".join(dynamic_string_parts)
 
     #Use dynamic_string in your script where needed
     #For example, in file naming or logging
     #print(f"Dynamic string: {dynamic_string}")
 
-    prepare_for_virtual_metabolization.list_compound_name = []
-    prepare_for_virtual_metabolization.list_smiles = []
-    job_id = args.job_id
+    list_compound_name = []
+    list_smiles = []
 
     print( '###MOLECULAR NETWORKING ')
-    if args.job_id.lower() !='false':
-        job_id = args.job_id
-        gnps_download_results(job_id, output_folder=job_id)
+    if use_gnps_job:
+        df_gnps_annotations = load_gnps_annotations(job_id, force_refresh=args.force_refresh)
 
         gnps_download_results_df_annotations_filtered = gnps_filter_annotations(
-            gnps_download_results.df_annotations, 'INCHI', 
+            df_gnps_annotations, 'INCHI', 
             args.ionisation_mode, args.max_ppm_error, args.min_cosine, 
             args.shared_peaks, args.max_spec_charge, prefix='')
 
@@ -154,12 +262,13 @@ def main(args):
         #print('Number of annotations after filtering = ' + str(df_annotations_filtered.shape[0]))
         print( '')
 
-        prepare_for_virtual_metabolization(df_annotations_filtered,
+        prepared = prepare_for_virtual_metabolization(df_annotations_filtered,
                                         compound_name='Compound_Name',
                                         smiles_column='Consol_SMILES', 
                                         smiles_planar_column='Consol_SMILES_iso',
                                         drop_duplicated_structure=True, 
                                         use_planar_structure=args.use_planar_structure_boolean)
+        list_compound_name, list_smiles = prepared.compound_names, prepared.smiles
 
         print( '')
 
@@ -175,17 +284,18 @@ def main(args):
             print("Loading SIRIUS input data...")
             df_sirius = load_csifingerid_cosmic_annotations(args.sirius_input_file)
 
-            #Apply filtering based on scores and database links
-            df_score_filtered = df_csifingerid_cosmic_annotations_filtering(df_sirius, args.zodiac_score, args.confidence_score)
-            df_db_links_filtered = df_csifingerid_cosmic_annotations_filtering(df_sirius, links=args.db_links)
-            df_score_filtered = pd.concat([df_score_filtered, df_db_links_filtered], axis=0, ignore_index=True)
+            #Keep the annotations passing the score thresholds or matching the database links, in a single slice
+            sirius_mask = (csifingerid_cosmic_scores_mask(df_sirius, args.zodiac_score, args.confidence_score)
+                           | csifingerid_cosmic_links_mask(df_sirius, args.db_links))
+            df_score_filtered = df_sirius.loc[sirius_mask].reset_index(drop=True)
 
             #Prepare for virtual metabolization
-            prepare_for_virtual_metabolization(df_score_filtered,
+            prepared = prepare_for_virtual_metabolization(df_score_filtered,
                                             compound_name='name',
                                             smiles_planar_column='smiles',
                                             drop_duplicated_structure=True, 
                                             use_planar_structure=True)
+            list_compound_name, list_smiles = prepared.compound_names, prepared.smiles
 
             print("SIRIUS input data processed.")
     else:
@@ -195,90 +305,128 @@ def main(args):
     #Optional: Load and append extra compounds
     if args.extra_compounds_table_file:
         print( '')
-        load_extra_compounds(args.extra_compounds_table_file)
-        append_to_list_if_not_present(prepare_for_virtual_metabolization.list_compound_name, 
-                                      prepare_for_virtual_metabolization.list_smiles, 
-                                      load_extra_compounds.extra_compound_names, 
-                                      load_extra_compounds.extra_compound_smiles)
+        extra_compounds = load_extra_compounds(args.extra_compounds_table_file)
+        append_to_list_if_not_present(list_compound_name, 
+                                      list_smiles, 
+                                      extra_compounds.compound_names, 
+                                      extra_compounds.smiles)
     else:
         print('No user provided compound list were given')
 
     if args.debug:
         print("####Running in debug mode. Limiting to {} compounds. #####".format(args.max_compounds_debug))
-        prepare_for_virtual_metabolization.list_compound_name = prepare_for_virtual_metabolization.list_compound_name[:args.max_compounds_debug]
-        prepare_for_virtual_metabolization.list_smiles = prepare_for_virtual_metabolization.list_smiles[:args.max_compounds_debug]
+        list_compound_name = list_compound_name[:args.max_compounds_debug]
+        list_smiles = list_smiles[:args.max_compounds_debug]
 
+    #SyGMa and BioTransformer are independent, so they run concurrently. The banners are printed
+    #before the work starts, and each step's captured output is printed as soon as that step is done.
+    steps = {}
     if args.run_sygma:
         print( '')
         print( '')
         print( '###RUNNING SyGMa - PLEASE WAIT ...')
-        with CaptureOutput() as captured:
-            run_sygma_batch(prepare_for_virtual_metabolization.list_smiles, 
-                            prepare_for_virtual_metabolization.list_compound_name, 
-                            args.phase_1_cycle, args.phase_2_cycle, args.top_sygma_candidates, 
-                            dynamic_string, 'Compound_Name')
-
-        filtered_output = captured.get_filtered_output()
-        print(filtered_output)
-
-        display(Markdown(run_sygma_batch.markdown_link_sygma))
-        print('Results are at: '+run_sygma_batch.file_name_sygma)
-        display(Markdown(run_sygma_batch.markdown_link_sygma_nap))
-        print('Results are at: '+run_sygma_batch.file_name_sygma_nap)
-        display(Markdown(run_sygma_batch.markdown_link_sygma_sirius))
-        print('Results are at: '+run_sygma_batch.file_name_sygma_sirius)
-
+        steps['SyGMa'] = run_sygma_step
     #Optional: Run BioTransformation
     if args.run_biotransformer:
-        preparation = False
         print( '')
         print( '')
-        print( '###PREPARING THE SETUP FOR BioTransformer3 - PLEASE WAIT (slow)...')
+        print( '###PREPARING THE SETUP AND RUNNING BioTransformer3 - PLEASE WAIT (slow)...')
+        steps['BioTransformer3'] = run_biotransformer_step
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {executor.submit(run_captured, step, args, list_smiles, list_compound_name, dynamic_string): name
+                   for name, step in steps.items()}
+        for future in as_completed(futures):
+            output, error = future.result()
+            print(output)
+            if error is not None:
+                #Report the failure right away; a step that is still running cannot be interrupted
+                logging.error("####%s failed: %s", futures[future], error, exc_info=error)
+                errors.append(error)
+    if errors:
+        raise errors[0]
 
+    print( '')
+    logging.info("####vm_NAP script finished successfully !")
+    logging.info("##Download the results with the button below and proceed with NAP and/or SIRIUS ")
+    
+
+def run_captured(step, *step_args):
+    """
+    Run a workflow step with its standard output captured, so that it can run in a worker thread.
+    Returns the captured output and the exception raised by the step (None if it succeeded).
+    """
+    error = None
+    with CaptureOutput(excluded_prefixes=()) as captured:
         try:
-            with CaptureOutput() as captured_prep:
-                prepare_for_bio3(args.type_of_biotransformation, prepare_for_virtual_metabolization.list_smiles)
-            filtered_output_prep = captured_prep.get_filtered_output()
-            print(filtered_output_prep)
-            preparation = True
+            step(*step_args)
         except Exception as e:
-            print("Error while running prepare_for_bio3: {}".format(e))
-        
-        print( '')
-        print( '')
-        print( '###RUNNING BioTransformer3 - PLEASE WAIT (slow)...')
-        if preparation == True:
-            with CaptureOutput() as captured:
-                run_biotransformer3(args.mode, prepare_for_virtual_metabolization.list_smiles, 
-                                    prepare_for_virtual_metabolization.list_compound_name,
-                                    args.type_of_biotransformation, args.number_of_steps, dynamic_string)
-            filtered_output = captured.get_filtered_output()
-            print(filtered_output)
-        else:
-            print("Biotransformer3 was not run due to an error in the preparation step.")
-       
-        display(Markdown(run_biotransformer3.markdown_link_biotransf))
-        print('Results are at: '+run_biotransformer3.file_name_biotransf)
-        display(Markdown(run_biotransformer3.markdown_link_biotransf_nap))
-        print('Results are at: '+run_biotransformer3.file_name_biotransf_nap)
-        display(Markdown(run_biotransformer3.markdown_link_biotransf_sirius))
-        print('Results are at: '+run_biotransformer3.file_name_biotransf_sirius)
+            error = e
+    return captured.get_filtered_output(), error
 
+def run_sygma_step(args, list_smiles, list_compound_name, dynamic_string):
+    """
+    Run SyGMa on the compound list and print the links to the results.
+    """
+    with CaptureOutput() as captured:
+        run_sygma_batch(list_smiles, 
+                        list_compound_name, 
+                        args.phase_1_cycle, args.phase_2_cycle, args.top_sygma_candidates, 
+                        dynamic_string, 'Compound_Name')
+
+    filtered_output = captured.get_filtered_output()
+    print(filtered_output)
+
+    display(Markdown(run_sygma_batch.markdown_link_sygma))
+    print('Results are at: '+run_sygma_batch.file_name_sygma)
+    display(Markdown(run_sygma_batch.markdown_link_sygma_nap))
+    print('Results are at: '+run_sygma_batch.file_name_sygma_nap)
+    display(Markdown(run_sygma_batch.markdown_link_sygma_sirius))
+    print('Results are at: '+run_sygma_batch.file_name_sygma_sirius)
+
+def run_biotransformer_step(args, list_smiles, list_compound_name, dynamic_string):
+    """
+    Prepare and run BioTransformer3 on the compound list and print the links to the results.
+    """
+    preparation = False
     print( '')
-    logging.info("####vm_NAP script finished successfully !")
-    logging.info("##Download the results with the button below and proceed with NAP and/or SIRIUS ")
+    print( '###BioTransformer3 setup')
+    try:
+        with CaptureOutput(excluded_prefixes=()) as captured_prep:
+            prepare_for_bio3(args.type_of_biotransformation, list_smiles)
+        filtered_output_prep = captured_prep.get_filtered_output()
+        print(filtered_output_prep)
+        preparation = True
+    except Exception as e:
+        print("Error while running prepare_for_bio3: {}".format(e))
     
+    print( '')
+    print( '###BioTransformer3 results')
+    if preparation == True:
+        with CaptureOutput() as captured:
+            run_biotransformer3(args.mode, list_smiles, 
+                                list_compound_name,
+                                args.type_of_biotransformation, args.number_of_steps, dynamic_string)
+        filtered_output = captured.get_filtered_output()
+        print(filtered_output)
+    else:
+        print("Biotransformer3 was not run due to an error in the preparation step.")
+   
+    display(Markdown(run_biotransformer3.markdown_link_biotransf))
+    print('Results are at: '+run_biotransformer3.file_name_biotransf)
+    display(Markdown(run_biotransformer3.markdown_link_biotransf_nap))
+    print('Results are at: '+run_biotransformer3.file_name_biotransf_nap)
+    display(Markdown(run_biotransformer3.markdown_link_biotransf_sirius))
+    print('Results are at: '+run_biotransformer3.file_name_biotransf_sirius)
 
 def apply_filtering(df_annotations, compound_name_to_keep):
-    list_compounds = set(df_annotations['Compound_Name'])
-    print(list_compounds)
-    if compound_name_to_keep is None:
+    """
+    Keep only the annotations whose Compound_Name is in compound_name_to_keep (no filtering if none are given).
+    """
+    if not compound_name_to_keep:
         return df_annotations
-    elif compound_name_to_keep:
-        print('After filtering')
-        list_compounds = set(f_annotations_filtered['Compound_Name'])
-        print(list_compounds)
-        return df_annotations_filtered(df_annotations, compound_name=compound_name_to_keep)
+    return df_annotations_filtering(df_annotations, compound_name=compound_name_to_keep)
 
 def validate_mode_arg(value):
     allowed_modes = ['standard', 'btType']  #Replace with your actual mode values
@@ -298,6 +446,79 @@ def positive_int_limited(value):
     except ValueError:
         raise argparse.ArgumentTypeError("Invalid integer value")
 
+#Build the command-line parser once; later calls reuse the cached instance
+@lru_cache(maxsize=1)
+def build_parser():
+    parser = argparse.ArgumentParser(
+    description="vm_NAP processing: A tool for integrating molecular networking, virtual metabolism, and annotation propagation for xenobiotic metabolites.",
+    epilog="Example usage:\n"
+           "  python vm_NAP_processing.py --run_biotransformer --type_of_biotransformation='hgut' --debug\n"
+           "  python vm_NAP_processing.py --debug --extra_compounds_table_file='input/extra_compounds-UTF8.tsv' --run_biotransformer\n"
+           "  python vm_NAP_processing.py --job_id='bbee697a63b1400ea585410fafc95723' --ionisation_mode='neg' --run_sygma\n"
+           "  python vm_NAP_processing.py --job_id='false' --extra_compounds_table_file='input/extra_compounds.tsv' --run_sygma --run_biotransformer\n"
+           "  python vm_NAP_processing.py --debug --run_sygma --phase_1_cycle=2 --phase_2_cycle=1\n"
+           "  python vm_NAP_processing.py --debug --run_sygma --sirius_input_file= input/compound_identifications.tsv\n"
+           "  python vm_NAP_processing.py --job_id='false' --extra_compounds_table_file='input/extra_compounds.tsv' --run_biotransformer --mode='standard'\n\n"
+           "Example usage with -k flag:\n"
+           "  python vm_NAP_processing.py --run_biotransformer --mode='-k pred -b superbio -a'\n"
+           "  python vm_NAP_processing.py --run_biotransformer --mode='-k pred -b allHuman -s 2 -cm 3'\n"
+           "  python vm_NAP_processing.py --run_biotransformer --mode='-k cid -b allHuman -s 2 -m \"292.0946;304.0946\" -t 0.01 -a'\n"
+           "  python vm_NAP_processing.py --run_biotransformer --mode='-k pred -q \"cyp450:2; phaseII:1\"'",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    #parser.add_argument("--streamlit", action='store_true', default=False, help="Run the streamlit instance instead of the commandline")
+
+    #GNPS job parameters
+    gnps_group = parser.add_argument_group('GNPS Parameters')
+    gnps_group.add_argument("--job_id", type=str, default='False', help="GNPS job ID for downloading and processing GNPS data ('bbee697a63b1400ea585410fafc95723'). The value 'False' can be used to skip this step")
+    gnps_group.add_argument("--ionisation_mode", type=str, default='pos', choices=['pos', 'neg'], help="Ionisation mode used in the GNPS job (positive or negative).")
+    gnps_group.add_argument("--max_ppm_error", type=int, default=10, help="Maximum allowed parts-per-million error for spectral matching.")
+    gnps_group.add_argument("--min_cosine", type=float, default=0.6, help="Minimum cosine score for considering spectral matches.")
+    gnps_group.add_argument("--shared_peaks", type=int, default=3, help="Minimum number of shared peaks for considering spectral matches.")
+    gnps_group.add_argument("--max_spec_charge", type=int, default=2, help="Maximum charge state of spectra to consider.")
+    gnps_group.add_argument("--force_refresh", action='store_true', help="Download the GNPS job results again even if a cached copy exists in the job folder.")
+
+    #Metadata filtering
+    metadata_group = parser.add_argument_group('Metadata Filtering')
+    metadata_group.add_argument("--compound_name_to_keep", nargs='*', default=None, help="List of compound names to keep for filtering. If not provided, no filtering is applied.")
+
+    #Extra structure file
+    extra_compounds_group = parser.add_argument_group('Extra Compounds')
+    extra_compounds_group.add_argument("--extra_compounds_table_file", type=str, default=None, help="Path to a file containing extra compounds to be included in the analysis (tab-separated, .parquet or .feather).")
+
+    #SIRIUS Parameters
+    sirius_group = parser.add_argument_group('SIRIUS Parameters')
+    sirius_group.add_argument("--sirius_input_file", type=str, default=None, help="Path to the SIRIUS structure annotation file (compound_annotations.tsv).")
+    sirius_group.add_argument("--zodiac_score", type=float, default=0.7, help="Zodiac score threshold for filtering SIRIUS results.")
+    sirius_group.add_argument("--confidence_score", type=float, default=0.1, help="Confidence score threshold for filtering SIRIUS results.")
+    sirius_group.add_argument("--db_links", type=str, default='KEGG|HMDB', help="Database links for filtering SIRIUS results.")
+
+    #Structure parameters
+    structure_group = parser.add_argument_group('Structure Parameters')
+    structure_group.add_argument("--use_planar_structure_boolean", type=bool, default=True, help="Flag to use planar structures for virtual metabolization.")
+
+    #Metabolisation parameters
+    metabolisation_group = parser.add_argument_group('Metabolisation Parameters')
+    metabolisation_group.add_argument("--run_sygma", action='store_true', default=True, help="Flag to run SyGMa for virtual metabolism prediction.")
+    metabolisation_group.add_argument("--phase_1_cycle", type=positive_int_limited, default=1, help="Number of phase 1 metabolism cycles to simulate in SyGMa.")
+    metabolisation_group.add_argument("--phase_2_cycle", type=positive_int_limited, default=1, help="Number of phase 2 metabolism cycles to simulate in SyGMa.")
+    metabolisation_group.add_argument("--top_sygma_candidates", type=int, default=10, help="Number of top SyGMa metabolite candidates to consider.")
+
+    #BioTransformer3
+    biotransformer_group = parser.add_argument_group('BioTransformer Parameters')
+    biotransformer_group.add_argument("--run_biotransformer", action='store_true', help="Flag to run BioTransformer for metabolism prediction.")
+    biotransformer_group.add_argument("--mode", type=validate_mode_arg, default='btType', help="Mode for running BioTransformer. Use 'btType', or custom mode string input for Biotransformer starting with '-k'.")
+    biotransformer_group.add_argument("--type_of_biotransformation", type=str, choices=['ecbased', 'cyp450', 'phaseII', 'hgut', 'superbio', 'allHuman', 'envimicro'], default='allHuman', help="Type of biotransformation to simulate in BioTransformer.")
+    biotransformer_group.add_argument("--number_of_steps", type=positive_int_limited, default=1, help="Number of biotransformation steps to simulate in BioTransformer.")
+
+    #Debug mode
+    parser.add_argument("--debug", action='store_true', help="Run in debug mode with limited data for testing purposes.")
+    parser.add_argument("--max_compounds_debug", type=int, default=3, 
+                    help="Maximum number of compounds to process in debug mode.")
+
+    return parser
+
 #Wrapper function to decide which main function to call
 def run_main():
 
@@ -309,74 +530,8 @@ def run_main():
 
     else:
         #Running in command-line
-        parser = argparse.ArgumentParser(
-        description="vm_NAP processing: A tool for integrating molecular networking, virtual metabolism, and annotation propagation for xenobiotic metabolites.",
-        epilog="Example usage:\n"
-               "  python vm_NAP_processing.py --run_biotransformer --type_of_biotransformation='hgut' --debug\n"
-               "  python vm_NAP_processing.py --debug --extra_compounds_table_file='input/extra_compounds-UTF8.tsv' --run_biotransformer\n"
-               "  python vm_NAP_processing.py --job_id='bbee697a63b1400ea585410fafc95723' --ionisation_mode='neg' --run_sygma\n"
-               "  python vm_NAP_processing.py --job_id='false' --extra_compounds_table_file='input/extra_compounds.tsv' --run_sygma --run_biotransformer\n"
-               "  python vm_NAP_processing.py --debug --run_sygma --phase_1_cycle=2 --phase_2_cycle=1\n"
-               "  python vm_NAP_processing.py --debug --run_sygma --sirius_input_file= input/compound_identifications.tsv\n"
-               "  python vm_NAP_processing.py --job_id='false' --extra_compounds_table_file='input/extra_compounds.tsv' --run_biotransformer --mode='standard'\n\n"
-               "Example usage with -k flag:\n"
-               "  python vm_NAP_processing.py --run_biotransformer --mode='-k pred -b superbio -a'\n"
-               "  python vm_NAP_processing.py --run_biotransformer --mode='-k pred -b allHuman -s 2 -cm 3'\n"
-               "  python vm_NAP_processing.py --run_biotransformer --mode='-k cid -b allHuman -s 2 -m \"292.0946;304.0946\" -t 0.01 -a'\n"
-               "  python vm_NAP_processing.py --run_biotransformer --mode='-k pred -q \"cyp450:2; phaseII:1\"'",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-        )
-
-        #parser.add_argument("--streamlit", action='store_true', default=False, help="Run the streamlit instance instead of the commandline")
-
-        #GNPS job parameters
-        gnps_group = parser.add_argument_group('GNPS Parameters')
-        gnps_group.add_argument("--job_id", type=str, default='False', help="GNPS job ID for downloading and processing GNPS data ('bbee697a63b1400ea585410fafc95723'). The value 'False' can be used to skip this step")
-        gnps_group.add_argument("--ionisation_mode", type=str, default='pos', choices=['pos', 'neg'], help="Ionisation mode used in the GNPS job (positive or negative).")
-        gnps_group.add_argument("--max_ppm_error", type=int, default=10, help="Maximum allowed parts-per-million error for spectral matching.")
-        gnps_group.add_argument("--min_cosine", type=float, default=0.6, help="Minimum cosine score for considering spectral matches.")
-        gnps_group.add_argument("--shared_peaks", type=int, default=3, help="Minimum number of shared peaks for considering spectral matches.")
-        gnps_group.add_argument("--max_spec_charge", type=int, default=2, help="Maximum charge state of spectra to consider.")
-
-        #Metadata filtering
-        metadata_group = parser.add_argument_group('Metadata Filtering')
-        metadata_group.add_argument("--compound_name_to_keep", nargs='*', default=None, help="List of compound names to keep for filtering. If not provided, no filtering is applied.")
-
-        #Extra structure file
-        extra_compounds_group = parser.add_argument_group('Extra Compounds')
-        extra_compounds_group.add_argument("--extra_compounds_table_file", type=str, default=None, help="Path to a file containing extra compounds to be included in the analysis.")
-
-        #SIRIUS Parameters
-        sirius_group = parser.add_argument_group('SIRIUS Parameters')
-        sirius_group.add_argument("--sirius_input_file", type=str, default=None, help="Path to the SIRIUS structure annotation file (compound_annotations.tsv).")
-        sirius_group.add_argument("--zodiac_score", type=float, default=0.7, help="Zodiac score threshold for filtering SIRIUS results.")
-        sirius_group.add_argument("--confidence_score", type=float, default=0.1, help="Confidence score threshold for filtering SIRIUS results.")
-        sirius_group.add_argument("--db_links", type=str, default='KEGG|HMDB', help="Database links for filtering SIRIUS results.")
-
-        #Structure parameters
-        structure_group = parser.add_argument_group('Structure Parameters')
-        structure_group.add_argument("--use_planar_structure_boolean", type=bool, default=True, help="Flag to use planar structures for virtual metabolization.")
-
-        #Metabolisation parameters
-        metabolisation_group = parser.add_argument_group('Metabolisation Parameters')
-        metabolisation_group.add_argument("--run_sygma", action='store_true', default=True, help="Flag to run SyGMa for virtual metabolism prediction.")
-        metabolisation_group.add_argument("--phase_1_cycle", type=positive_int_limited, default=1, help="Number of phase 1 metabolism cycles to simulate in SyGMa.")
-        metabolisation_group.add_argument("--phase_2_cycle", type=positive_int_limited, default=1, help="Number of phase 2 metabolism cycles to simulate in SyGMa.")
-        metabolisation_group.add_argument("--top_sygma_candidates", type=int, default=10, help="Number of top SyGMa metabolite candidates to consider.")
-
-        #BioTransformer3
-        biotransformer_group = parser.add_argument_group('BioTransformer Parameters')
-        biotransformer_group.add_argument("--run_biotransformer", action='store_true', help="Flag to run BioTransformer for metabolism prediction.")
-        biotransformer_group.add_argument("--mode", type=validate_mode_arg, default='btType', help="Mode for running BioTransformer. Use 'btType', or custom mode string input for Biotransformer starting with '-k'.")
-        biotransformer_group.add_argument("--type_of_biotransformation", type=str, choices=['ecbased', 'cyp450', 'phaseII', 'hgut', 'superbio', 'allHuman', 'envimicro'], default='allHuman', help="Type of biotransformation to simulate in BioTransformer.")
-        biotransformer_group.add_argument("--number_of_steps", type=positive_int_limited, default=1, help="Number of biotransformation steps to simulate in BioTransformer.")
-
-        #Debug mode
-        parser.add_argument("--debug", action='store_true', help="Run in debug mode with limited data for testing purposes.")
-        parser.add_argument("--max_compounds_debug", type=int, default=3, 
-                        help="Maximum number of compounds to process in debug mode.")
-
-        args = parser.parse_args()
+        args = build_parser().parse_args()
+        configure_logging()
         main(args)
 
 